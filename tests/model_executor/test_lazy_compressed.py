@@ -0,0 +1,53 @@
+"""Tests for the 2:4 detection and promotion in LazyCompressedParameter.
+
+Run `pytest tests/model_executor/test_lazy_compressed.py`.
+"""
+from unittest.mock import patch
+
+import torch
+
+from magic_wand import (SparseBEGemmStorageFormat,
+                        SparseSemiStructuredStorageFormat)
+from vllm.model_executor.layers.parameters import LazyCompressedParameter
+from vllm.model_executor.layers.parameters.lazy_compressed import (
+    _has_semi_structured_pattern)
+
+
+def _semi_structured_tensor(rows: int = 32, cols: int = 64) -> torch.Tensor:
+    # 2 non-zeros in every group of 4 along the last dim
+    mask = torch.tensor([0, 0, 1, 1], dtype=torch.float16).repeat(cols // 4)
+    return torch.ones(rows, cols, dtype=torch.float16) * mask
+
+
+def test_semi_structured_pattern_accepted():
+    assert _has_semi_structured_pattern(_semi_structured_tensor())
+
+
+def test_too_many_nonzeros_in_group_rejected():
+    tensor = _semi_structured_tensor()
+    tensor[3, 4:8] = torch.tensor([1, 1, 1, 0], dtype=torch.float16)
+    assert not _has_semi_structured_pattern(tensor)
+
+
+def test_last_dim_not_multiple_of_4_rejected():
+    tensor = torch.zeros(32, 66, dtype=torch.float16)
+    assert not _has_semi_structured_pattern(tensor)
+
+
+def test_semi_structured_weight_promoted():
+    param = LazyCompressedParameter(
+        _semi_structured_tensor(),
+        storage_format_cls=SparseBEGemmStorageFormat,
+        compress_transposed=True,
+        prefer_semi_structured=True)
+    with patch.object(SparseSemiStructuredStorageFormat,
+                      "compress") as compress:
+        param.compress()
+
+    assert param.storage_format_cls is SparseSemiStructuredStorageFormat
+    assert not param.compress_transposed
+    assert param.has_compressed_data
+    assert not param.has_uncompressed_data
+    # compressed untransposed, i.e. in the (out, in) layout F.linear expects
+    compressed = compress.call_args.args[0]
+    assert compressed.shape == (32, 64)
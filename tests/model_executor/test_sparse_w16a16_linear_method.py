@@ -0,0 +1,165 @@
+"""Tests for SparseW16A16LinearMethod.
+
+Run `pytest tests/model_executor/test_sparse_w16a16_linear_method.py`.
+"""
+import functools
+from unittest.mock import MagicMock, patch
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from magic_wand import (SparseBEGemmStorageFormat, SparseBitmaskStorageFormat,
+                        SparseSemiStructuredStorageFormat)
+from vllm.model_executor.layers.sparsity.sparse_w16a16 import (
+    SparseW16A16Config)
+from vllm.model_executor.layers.sparsity import sparse_w16a16_linear_method
+from vllm.model_executor.layers.sparsity.sparse_w16a16_linear_method import (
+    SparseW16A16LinearMethod)
+
+SUPPORTED_FN = "_semi_structured_kernels_supported"
+
+
+def _load_weights(linear_method, data: torch.Tensor, kernels_supported: bool):
+    # Mirrors the weight loaders: create, copy in the data, then compress
+    out_features, in_features = data.shape
+    with patch.object(sparse_w16a16_linear_method,
+                      SUPPORTED_FN,
+                      return_value=kernels_supported):
+        weights = linear_method.create_weights(in_features, out_features,
+                                               in_features, out_features,
+                                               data.dtype)
+    weights["weight"].uncompressed_data.copy_(data)
+    weights["weight"].compress()
+    return weights
+
+
+def _semi_structured_tensor(rows: int = 32, cols: int = 64) -> torch.Tensor:
+    # 2 non-zeros in every group of 4 along the last dim
+    mask = torch.tensor([0, 0, 1, 1], dtype=torch.float32).repeat(cols // 4)
+    return torch.randn(rows, cols) * mask
+
+
+def _unstructured_tensor(rows: int = 32, cols: int = 64) -> torch.Tensor:
+    # Half of the elements zeroed, but with groups of 4 non-zeros, i.e. not 2:4
+    data = torch.randn(rows, cols)
+    data[:, cols // 2:] = 0
+    return data
+
+
+@pytest.mark.parametrize("kernels_supported", [True, False])
+def test_semi_structured_promotion_gated_on_hardware(kernels_supported):
+    linear_method = SparseW16A16Config().get_linear_method()
+    with patch.object(sparse_w16a16_linear_method,
+                      SUPPORTED_FN,
+                      return_value=kernels_supported):
+        weights = linear_method.create_weights(64, 32, 64, 32, torch.float16)
+    assert weights["weight"].prefer_semi_structured == kernels_supported
+
+
+def test_semi_structured_promotion_gated_on_shape():
+    linear_method = SparseW16A16Config().get_linear_method()
+    with patch.object(sparse_w16a16_linear_method,
+                      SUPPORTED_FN,
+                      return_value=True):
+        # 48 input features are not a multiple of the column alignment
+        weights = linear_method.create_weights(48, 32, 48, 32, torch.float16)
+    assert not weights["weight"].prefer_semi_structured
+
+
+def test_uncompressed_weight_uses_dense_linear():
+    linear_method = SparseW16A16Config().get_linear_method()
+    # Not sparse enough to be compressed
+    data = torch.randn(32, 64)
+    weights = _load_weights(linear_method, data, kernels_supported=False)
+    linear_method.process_weights_after_loading(weights)
+
+    x = torch.randn(2, 3, 64)
+    bias = torch.randn(32)
+    torch.testing.assert_close(linear_method.apply_weights(weights, x, bias),
+                               F.linear(x, data, bias))
+
+
+def test_be_gemm_weight_uses_be_ds_gemm():
+    linear_method = SparseW16A16Config().get_linear_method()
+    with patch.object(SparseBEGemmStorageFormat, "compress") as compress:
+        weights = _load_weights(linear_method,
+                                _unstructured_tensor(),
+                                kernels_supported=True)
+    # Compressed transposed for the basic matmul of be_ds_gemm
+    assert compress.call_args.args[0].shape == (64, 32)
+    linear_method.process_weights_after_loading(weights)
+
+    x = torch.randn(2, 3, 64)
+    with patch.object(sparse_w16a16_linear_method,
+                      "be_ds_gemm",
+                      return_value=torch.zeros(6, 32)) as be_ds_gemm:
+        output = linear_method.apply_weights(weights, x)
+
+    assert be_ds_gemm.call_args.args[0].shape == (6, 64)
+    assert be_ds_gemm.call_args.args[1] is compress.return_value
+    assert output.shape == (2, 3, 32)
+
+
+def test_semi_structured_weight_uses_semi_structured_linear():
+    linear_method = SparseW16A16Config().get_linear_method()
+    with patch.object(SparseSemiStructuredStorageFormat, "compress"):
+        weights = _load_weights(linear_method,
+                                _semi_structured_tensor(),
+                                kernels_supported=True)
+    assert (weights["weight"].storage_format_cls is
+            SparseSemiStructuredStorageFormat)
+    with patch.object(sparse_w16a16_linear_method,
+                      "_make_semi_structured_mm") as make_mm:
+        linear_method.process_weights_after_loading(weights)
+
+    x = torch.randn(2, 3, 64)
+    with patch.object(sparse_w16a16_linear_method,
+                      "_semi_structured_linear") as semi_structured_linear:
+        output = linear_method.apply_weights(weights, x)
+
+    semi_structured_linear.assert_called_once()
+    assert semi_structured_linear.call_args.args[0] is x
+    assert semi_structured_linear.call_args.args[1] is make_mm.return_value
+    assert output is semi_structured_linear.return_value
+
+
+def test_other_format_weight_uncompressed_after_loading():
+    linear_method = SparseW16A16LinearMethod(SparseW16A16Config(),
+                                             SparseBitmaskStorageFormat)
+    data = _unstructured_tensor()
+    compressed_data = MagicMock()
+    compressed_data.decompress.return_value = data
+    with patch.object(SparseBitmaskStorageFormat,
+                      "compress",
+                      return_value=compressed_data):
+        weights = _load_weights(linear_method, data, kernels_supported=True)
+    linear_method.process_weights_after_loading(weights)
+
+    assert not weights["weight"].has_compressed_data
+    assert weights["weight"].uncompressed_data is data
+    x = torch.randn(2, 3, 64)
+    torch.testing.assert_close(linear_method.apply_weights(weights, x),
+                               F.linear(x, data))
+
+
+def test_apply_fn_resolved_on_first_use():
+    linear_method = SparseW16A16Config().get_linear_method()
+    data = torch.randn(32, 64)
+    weights = _load_weights(linear_method, data, kernels_supported=False)
+    # process_weights_after_loading is not called, as for layers whose
+    # weights were loaded outside of get_model
+    x = torch.randn(2, 3, 64)
+    with patch.object(linear_method,
+                      "process_weights_after_loading",
+                      wraps=linear_method.process_weights_after_loading
+                      ) as process_weights:
+        first_output = linear_method.apply_weights(weights, x)
+        apply_fn = weights["weight"]._apply_fn
+        second_output = linear_method.apply_weights(weights, x)
+
+    process_weights.assert_called_once()
+    assert not isinstance(apply_fn, functools.partial)
+    assert weights["weight"]._apply_fn is apply_fn
+    torch.testing.assert_close(first_output, F.linear(x, data))
+    torch.testing.assert_close(second_output, first_output)
@@ -0,0 +1,47 @@
+"""Tests for the background prefetching of model weights.
+
+Run `pytest tests/model_executor/test_weight_utils.py`.
+"""
+import threading
+
+import pytest
+
+from vllm.model_executor.weight_utils import _prefetch_iterator
+
+
+def test_prefetch_iterator_keeps_order():
+    assert list(_prefetch_iterator(iter(range(100)))) == list(range(100))
+
+
+def test_prefetch_iterator_raises_inner_exception():
+
+    def failing_iterator():
+        yield 0
+        yield 1
+        raise RuntimeError("failed to read weights")
+
+    items = []
+    with pytest.raises(RuntimeError, match="failed to read weights"):
+        for item in _prefetch_iterator(failing_iterator()):
+            items.append(item)
+    assert items == [0, 1]
+
+
+def test_prefetch_iterator_early_close():
+    inner_closed = threading.Event()
+
+    def inner_iterator():
+        try:
+            for i in range(100):
+                yield i
+        finally:
+            inner_closed.set()
+
+    prefetch_iterator = _prefetch_iterator(inner_iterator())
+    assert next(prefetch_iterator) == 0
+
+    closer = threading.Thread(target=prefetch_iterator.close, daemon=True)
+    closer.start()
+    closer.join(timeout=10)
+    assert not closer.is_alive(), "closing the iterator hung"
+    assert inner_closed.is_set()
@@ -0,0 +1,35 @@
+"""Tests for the sparsity/quantization checks in ModelConfig.
+
+Run `pytest tests/test_config.py`.
+"""
+import pytest
+
+from vllm.config import ModelConfig
+
+MODEL_NAME = "facebook/opt-125m"
+
+
+def _model_config(**kwargs) -> ModelConfig:
+    return ModelConfig(
+        MODEL_NAME,
+        MODEL_NAME,
+        tokenizer_mode="auto",
+        trust_remote_code=False,
+        download_dir=None,
+        load_format="dummy",
+        seed=0,
+        dtype="float16",
+        **kwargs,
+    )
+
+
+def test_quantization_without_sparsity():
+    """Quantization alone must not be rejected by the sparsity checks."""
+    model_config = _model_config(quantization="gptq")
+    assert model_config.quantization == "gptq"
+    assert model_config.sparsity is None
+
+
+def test_quantization_with_sparsity_rejected():
+    with pytest.raises(ValueError, match="cannot be combined"):
+        _model_config(quantization="gptq", sparsity="sparse_w16a16")
@@ -150,10 +150,6 @@ class ModelConfig:
     def _verify_sparsity(self) -> None:
         supported_sparsity = ["sparse_w16a16", "semi_structured_sparse_w16a16"]
 
-        if self.quantization is not None:
-            raise ValueError("Both sparsity and quantization detected. Only "
-                             "one or the other is supported at a time.")
-
         if self.sparsity is not None and self.sparsity not in supported_sparsity:
             raise ValueError(f"Unknown sparse method: {self.sparsity}. Must "
                              f"be one of {supported_sparsity}.")
@@ -171,6 +167,14 @@ class ModelConfig:
                     f"method specified in the `sparsity` argument "
                     f"({self.sparsity}).")
 
+        # There are no kernels composing sparse weights with quantization,
+        # so reject the combination instead of letting one silently win.
+        if self.sparsity is not None and self.quantization is not None:
+            raise ValueError(
+                f"Sparsity method {self.sparsity} cannot be combined with "
+                f"quantization method {self.quantization}. Only one or the "
+                "other is supported at a time.")
+
     def _verify_quantization(self) -> None:
         supported_quantization = ["awq", "gptq", "squeezellm"]
         rocm_not_supported_quantization = ["awq"]
@@ -37,6 +37,12 @@ class LinearMethodBase(ABC):
         """Apply the weights to the input tensor."""
         raise NotImplementedError
 
+    # Deliberately a no-op hook, most linear methods need no post-processing.
+    def process_weights_after_loading(  # noqa: B027
+            self, weights: Dict[str, Any]) -> None:
+        """Prepare the loaded weights for inference, called once after all
+        weights of the model are loaded."""
+
 
 class UnquantizedLinearMethod(LinearMethodBase):
     """Linear method without quantization.
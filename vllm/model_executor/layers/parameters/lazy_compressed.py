@@ -3,7 +3,17 @@ import torch
 from torch.utils._pytree import tree_map
 
 from typing import Type
-from magic_wand import (CompressedStorageFormat, SparseBitmaskStorageFormat)
+from magic_wand import (CompressedStorageFormat, SparseBitmaskStorageFormat,
+                        SparseSemiStructuredStorageFormat)
+
+
+def _has_semi_structured_pattern(tensor: torch.Tensor) -> bool:
+    """Check whether every group of 4 consecutive elements along the last
+    dim holds at most 2 non-zeros, i.e. the tensor is 2:4 sparse."""
+    if tensor.shape[-1] % 4 != 0:
+        return False
+    nonzeros_per_group = torch.count_nonzero(tensor.reshape(-1, 4), dim=-1)
+    return bool((nonzeros_per_group <= 2).all())
 
 
 class LazyCompressedParameter(torch.Tensor):
@@ -13,7 +23,8 @@ class LazyCompressedParameter(torch.Tensor):
                 uncompressed_data: torch.Tensor,
                 storage_format_cls: Type[
                     CompressedStorageFormat] = SparseBitmaskStorageFormat,
-                compress_transposed: bool = False):
+                compress_transposed: bool = False,
+                prefer_semi_structured: bool = False):
         self = torch.Tensor._make_wrapper_subclass(
             cls,
             size=uncompressed_data.shape,
@@ -23,6 +34,9 @@ class LazyCompressedParameter(torch.Tensor):
         self.compressed_data = None
         self.uncompressed_data = uncompressed_data
         self.compress_transposed = compress_transposed
+        # if the loaded data turns out to be 2:4 sparse, compress it in the
+        # semi-structured format regardless of storage_format_cls
+        self.prefer_semi_structured = prefer_semi_structured
         self._is_param = True
 
         return self
@@ -71,6 +85,10 @@ class LazyCompressedParameter(torch.Tensor):
         if self.uncompressed_data is None:
             raise ValueError(
                 "Called compress() but uncompressed_data does not exist.")
+        if (self.prefer_semi_structured
+                and _has_semi_structured_pattern(self.uncompressed_data)):
+            self.storage_format_cls = SparseSemiStructuredStorageFormat
+            self.compress_transposed = False
         self.compressed_data = self.storage_format_cls.compress(
             self.uncompressed_data.t(
             ) if self.compress_transposed else self.uncompressed_data)
@@ -1,4 +1,5 @@
-from typing import Any, Dict, Optional, Type
+import functools
+from typing import Any, Callable, Dict, Optional, Tuple, Type
 
 import torch
 import torch.nn.functional as F
@@ -6,12 +7,151 @@ import torch.nn.functional as F
 from vllm.model_executor.layers.linear import LinearMethodBase, set_weight_attrs
 from vllm.model_executor.layers.sparsity.base_config import SparsityConfig
 from vllm.model_executor.layers.parameters import LazyCompressedParameter
-from magic_wand.semi_structured import (pad_tensor_to_multiple,
-                                        extract_valid_rows)
+from magic_wand.semi_structured import pad_tensor_to_multiple
 from magic_wand import (CompressedStorageFormat, SparseBEGemmStorageFormat,
                         SparseSemiStructuredStorageFormat)
 from magic_wand.ops import be_ds_gemm
 
+# Shape alignment required by the semi-structured (2:4) sparse kernels for
+# 16-bit weights of shape (rows, cols)
+_SEMI_STRUCTURED_ROW_ALIGNMENT = 32
+_SEMI_STRUCTURED_COL_ALIGNMENT = 64
+
+
+@functools.lru_cache(maxsize=None)
+def _semi_structured_kernels_supported() -> bool:
+    """Whether the current GPU can run the semi-structured (2:4) kernels."""
+    # The CUTLASS 2:4 kernels of torch 2.1 only support SM8x
+    return torch.cuda.get_device_capability()[0] == 8
+
+
+# Multiplies a 2D activation by a weight bound into the function
+MatmulFn = Callable[[torch.Tensor], torch.Tensor]
+
+# Zero biases shared by all layers with the same output size, dtype and device
+_ZERO_BIAS_CACHE: Dict[Tuple[torch.dtype, torch.device, int],
+                       torch.Tensor] = {}
+
+
+def _get_zero_bias(size: int, dtype: torch.dtype,
+                   device: torch.device) -> torch.Tensor:
+    key = (dtype, device, size)
+    zero_bias = _ZERO_BIAS_CACHE.get(key)
+    if zero_bias is None:
+        zero_bias = torch.zeros((size, ), dtype=dtype, device=device)
+        _ZERO_BIAS_CACHE[key] = zero_bias
+    return zero_bias
+
+
+def _get_cutlass_operands(
+        w_encap: torch.Tensor) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+    """Returns the (sparse values, metadata) CUTLASS operands of a 2:4 sparse
+    tensor, or None if it was not compressed for CUTLASS."""
+    if (not hasattr(torch, "_sparse_semi_structured_linear")
+            or getattr(w_encap, "transposed", False)):
+        return None
+    # torch >= 2.2 keeps the CUTLASS operands in dedicated fields
+    sparse_tensor = getattr(w_encap, "sparse_tensor_cutlass", None)
+    meta_tensor = getattr(w_encap, "meta_tensor_cutlass", None)
+    if sparse_tensor is not None and meta_tensor is not None:
+        return sparse_tensor, meta_tensor
+    # torch 2.1 packs them into compressed_tensor, which values() and
+    # indices() only unpack correctly if it was compressed for CUTLASS
+    if (getattr(w_encap, "compressed_tensor", None) is not None
+            and getattr(w_encap, "_FORCE_CUTLASS", False)):
+        return w_encap.values(), w_encap.indices()
+    return None
+
+
+def _make_semi_structured_mm(w_encap: torch.Tensor) -> MatmulFn:
+    """Returns a function multiplying a 2D activation by a 2:4 sparse weight,
+    i.e. x @ w_encap.T, with the kernel and its operands resolved up front."""
+    cutlass_operands = _get_cutlass_operands(w_encap)
+    if cutlass_operands is not None:
+        # Call the CUTLASS op directly instead of dispatching F.linear
+        # through the tensor subclass. The op's bias is optional, so no zero
+        # bias is passed (or added) on this path
+        sparse_tensor, meta_tensor = cutlass_operands
+        return functools.partial(torch._sparse_semi_structured_linear,
+                                 weight=sparse_tensor,
+                                 meta=meta_tensor)
+    # The semi-structured F.linear dispatch requires an explicit bias
+    zero_bias = _get_zero_bias(w_encap.shape[0], w_encap.dtype, w_encap.device)
+    return functools.partial(F.linear, weight=w_encap, bias=zero_bias)
+
+
+def _semi_structured_linear(x: torch.Tensor, mm: MatmulFn,
+                            out_features: int) -> torch.Tensor:
+    """Apply a 2:4 sparse matmul to an activation of arbitrary leading dims.
+
+    Flattens `x` to 2D, pads the rows to a multiple of 8 when required by the
+    semi-structured kernels, runs the sparse matmul and restores the original
+    leading dims.
+    """
+    out_shape = (x.shape[:-1] + (out_features, ))
+    reshaped_x = x.reshape(-1, x.shape[-1])
+    num_rows = reshaped_x.shape[0]
+    # Only pad (and later unpad) when the rows are not already
+    # aligned to what the 2:4 kernels require
+    needs_padding = (num_rows % 8 != 0 or not reshaped_x.is_contiguous())
+    if needs_padding:
+        reshaped_x, _ = pad_tensor_to_multiple(reshaped_x, 8)
+    output = mm(reshaped_x)
+    if needs_padding:
+        # Padding is appended after the valid rows, so dropping it is a view
+        output = output.narrow(0, 0, num_rows)
+    return output.contiguous().reshape(out_shape)
+
+
+# The functions below build the apply function of a single loaded weight,
+# with everything that is fixed once the weight is loaded bound up front.
+# Apply functions take the activation and the (optional) bias.
+ApplyFn = Callable[[torch.Tensor, Optional[torch.Tensor]], torch.Tensor]
+ApplyFnFactory = Callable[[LazyCompressedParameter], ApplyFn]
+
+
+def _make_uncompressed_apply(w: LazyCompressedParameter) -> ApplyFn:
+    weight = w.uncompressed_data
+
+    def apply(x: torch.Tensor, bias: Optional[torch.Tensor]) -> torch.Tensor:
+        return F.linear(x, weight, bias)
+
+    return apply
+
+
+def _make_semi_structured_apply(w: LazyCompressedParameter) -> ApplyFn:
+    w_encap = w.compressed_data.encapsulated_torch_sparse_tensor
+    mm = _make_semi_structured_mm(w_encap)
+    out_features = w_encap.shape[0]
+
+    def apply(x: torch.Tensor, bias: Optional[torch.Tensor]) -> torch.Tensor:
+        assert bias is None
+        return _semi_structured_linear(x, mm, out_features)
+
+    return apply
+
+
+def _make_be_gemm_apply(w: LazyCompressedParameter) -> ApplyFn:
+    assert w.compress_transposed
+    compressed_data = w.compressed_data
+    out_features = w.shape[0]
+
+    def apply(x: torch.Tensor, bias: Optional[torch.Tensor]) -> torch.Tensor:
+        assert bias is None
+        out_shape = (x.shape[:-1] + (out_features, ))
+        y = be_ds_gemm(x.reshape(-1, x.shape[-1]), compressed_data)
+        return y.reshape(out_shape)
+
+    return apply
+
+
+# Sparse kernel to use for each compressed storage format, weights in other
+# formats are uncompressed after loading
+_APPLY_FN_FACTORIES: Dict[Type[CompressedStorageFormat], ApplyFnFactory] = {
+    SparseSemiStructuredStorageFormat: _make_semi_structured_apply,
+    SparseBEGemmStorageFormat: _make_be_gemm_apply,
+}
+
 
 class SparseW16A16LinearMethod(LinearMethodBase):
     """Linear method for Sparse W16A16.
@@ -32,53 +172,63 @@ class SparseW16A16LinearMethod(LinearMethodBase):
                        params_dtype: torch.dtype) -> Dict[str, Any]:
         supports_linear = (self.storage_format_cls !=
                            SparseBEGemmStorageFormat)
+        # 2:4 sparse weights run faster through the semi-structured kernels
+        # than through the BE-GEMM kernel, if the GPU and shape support them
+        prefer_semi_structured = (
+            self.storage_format_cls == SparseBEGemmStorageFormat
+            and _semi_structured_kernels_supported()
+            and output_size_per_partition % _SEMI_STRUCTURED_ROW_ALIGNMENT == 0
+            and input_size_per_partition % _SEMI_STRUCTURED_COL_ALIGNMENT == 0)
         weight = LazyCompressedParameter(
             torch.empty((output_size_per_partition, input_size_per_partition),
                         dtype=params_dtype),
             storage_format_cls=self.storage_format_cls,
             # if we don't support F.linear or something analogous,
             # transpose when we compress so we can use a basic matmul
-            compress_transposed=not supports_linear)
+            compress_transposed=not supports_linear,
+            prefer_semi_structured=prefer_semi_structured)
 
         set_weight_attrs(weight, {"input_dim": 1, "output_dim": 0})
+        # Replaced by process_weights_after_loading, this resolves it on first
+        # use for layers whose weights were loaded outside of get_model
+        weight._apply_fn = functools.partial(self._resolve_and_apply, weight)
 
         return {"weight": weight}
 
+    def process_weights_after_loading(self, weights: Dict[str, Any]) -> None:
+        w: LazyCompressedParameter = weights["weight"]
+        if (w.has_compressed_data
+                and w.storage_format_cls not in _APPLY_FN_FACTORIES):
+            # A dense matmul gains nothing from the compressed format, so
+            # uncompress to dense once instead of decompressing on every call
+            assert not w.compress_transposed
+            w.uncompressed_data = w.compressed_data.decompress()
+            w.compressed_data = None
+
+        # The kernel and its operands are fixed once the weight is loaded, so
+        # resolve them now rather than on every forward
+        if w.has_uncompressed_data:
+            # never compressed (likely due to insufficient sparsity)
+            assert not w.has_compressed_data
+            w._apply_fn = _make_uncompressed_apply(w)
+        else:
+            # Dispatch on the weight's format rather than
+            # self.storage_format_cls as weights may have been promoted to
+            # 2:4 when compressed
+            w._apply_fn = _APPLY_FN_FACTORIES[w.storage_format_cls](w)
+
     def apply_weights(
         self,
         weights: Dict[str, Any],
         x: torch.Tensor,
         bias: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
-        w: LazyCompressedParameter = weights["weight"]
+        # NOTE: This also runs under CUDA graph capture. All state the apply
+        # functions hold (e.g. zero biases) is set up when the weights are
+        # loaded, so capture never creates or mutates cached state.
+        return weights["weight"]._apply_fn(x, bias)
 
-        # if we never compressed (likely due to insufficient sparsity),
-        # i.e. have uncompressed_data run normally
-        if w.has_uncompressed_data:
-            assert not w.has_compressed_data
-            output = F.linear(x, w.uncompressed_data, bias)
-        elif self.storage_format_cls == SparseSemiStructuredStorageFormat:
-            assert bias is None
-            w_encap = w.compressed_data.encapsulated_torch_sparse_tensor
-            out_shape = (x.shape[:-1] + (w_encap.shape[0], ))
-            reshaped_x, valid_rows_range = pad_tensor_to_multiple(
-                x.reshape(-1, x.shape[-1]), 8)
-            output = F.linear(
-                reshaped_x, w_encap,
-                torch.nn.Parameter(torch.zeros((w_encap.shape[0], ))).to(
-                    reshaped_x.dtype).to(reshaped_x.device)).contiguous()
-            output = extract_valid_rows(output, valid_rows_range)
-            return output.reshape(out_shape)
-        elif self.storage_format_cls == SparseBEGemmStorageFormat:
-            assert bias is None
-            assert w.compress_transposed
-            out_shape = (x.shape[:-1] + (w.shape[0], ))
-            reshaped_x = x.reshape(-1, x.shape[-1])
-            y = be_ds_gemm(reshaped_x, w.compressed_data)
-            return y.reshape(out_shape)
-        else:
-            # Standard matrix multiply
-            # Uncompress to dense
-            assert not w.compress_transposed
-            output = F.linear(x, w.compressed_data.decompress(), bias)
-        return output
+    def _resolve_and_apply(self, w: LazyCompressedParameter, x: torch.Tensor,
+                           bias: Optional[torch.Tensor]) -> torch.Tensor:
+        self.process_weights_after_loading({"weight": w})
+        return w._apply_fn(x, bias)
@@ -1,16 +1,22 @@
 """Utilities for selecting and loading models."""
 import contextlib
-from typing import Optional, Type
+import functools
+import threading
+from typing import Optional, Type, Union
 
 import torch
 import torch.nn as nn
 from transformers import PretrainedConfig
 
 from vllm.config import ModelConfig, LoRAConfig
+from vllm.model_executor.layers.linear import LinearMethodBase
+from vllm.model_executor.layers.quantization import QuantizationConfig
+from vllm.model_executor.layers.sparsity import SparsityConfig
 from vllm.model_executor.models import ModelRegistry
 from vllm.model_executor.weight_utils import (get_quant_config,
                                               get_sparse_config,
-                                              initialize_dummy_weights)
+                                              initialize_dummy_weights,
+                                              prefetch_hf_model_weights)
 
 
 @contextlib.contextmanager
@@ -22,6 +28,13 @@ def _set_default_torch_dtype(dtype: torch.dtype):
     torch.set_default_dtype(old_dtype)
 
 
+@functools.lru_cache(maxsize=None)
+def _get_device_capability() -> int:
+    """Returns the compute capability of the current GPU, e.g. 80 for SM80."""
+    capability = torch.cuda.get_device_capability()
+    return capability[0] * 10 + capability[1]
+
+
 def _get_model_architecture(config: PretrainedConfig) -> Type[nn.Module]:
     architectures = getattr(config, "architectures", [])
     for arch in architectures:
@@ -33,9 +46,55 @@ def _get_model_architecture(config: PretrainedConfig) -> Type[nn.Module]:
         f"Supported architectures: {ModelRegistry.get_supported_archs()}")
 
 
+def _get_linear_method(
+    config: Union[QuantizationConfig, SparsityConfig],
+    method: str,
+    kind: str,
+    dtype: torch.dtype,
+) -> LinearMethodBase:
+    """Validates the GPU and dtype against a quantization or sparsity config
+    and returns its linear method.
+
+    Args:
+        config: The quantization or sparsity config.
+        method: The name of the method, used in error messages.
+        kind: Either "quantization" or "sparsity", used in error messages.
+        dtype: The model dtype.
+    """
+    capability = _get_device_capability()
+    if capability < config.get_min_capability():
+        raise ValueError(
+            f"The {kind} method {method} is not supported for the current "
+            f"GPU. Minimum capability: {config.get_min_capability()}. "
+            f"Current capability: {capability}.")
+    supported_dtypes = config.get_supported_act_dtypes()
+    if dtype not in supported_dtypes:
+        raise ValueError(
+            f"{dtype} is not supported for {kind} method {method}. "
+            f"Supported dtypes: {supported_dtypes}")
+    return config.get_linear_method()
+
+
+def _prefetch_weights(model_config: ModelConfig) -> None:
+    # Prefetching is best effort, any error it hits is raised again by
+    # load_weights.
+    with contextlib.suppress(Exception):
+        prefetch_hf_model_weights(model_config.model,
+                                  model_config.download_dir,
+                                  model_config.load_format,
+                                  model_config.revision)
+
+
 def get_model(model_config: ModelConfig,
               lora_config: Optional[LoRAConfig] = None) -> nn.Module:
     model_class = _get_model_architecture(model_config.hf_config)
+    supports_lora = getattr(model_class, "supports_lora", False)
+    if lora_config and not supports_lora:
+        raise ValueError(
+            f"Model {model_class.__name__} does not support LoRA, "
+            "but LoRA is enabled. Support for this model may "
+            "be added in the future. If this is important to you, "
+            "please open an issue on github.")
 
     # Get the (maybe sparse or quantized) linear method.
     linear_method = None
@@ -44,55 +103,35 @@ def get_model(model_config: ModelConfig,
                                         model_config.model,
                                         model_config.hf_config,
                                         model_config.download_dir)
-        capability = torch.cuda.get_device_capability()
-        capability = capability[0] * 10 + capability[1]
-        if capability < quant_config.get_min_capability():
-            raise ValueError(
-                f"The quantization method {model_config.quantization} is not "
-                "supported for the current GPU. "
-                f"Minimum capability: {quant_config.get_min_capability()}. "
-                f"Current capability: {capability}.")
-        supported_dtypes = quant_config.get_supported_act_dtypes()
-        if model_config.dtype not in supported_dtypes:
-            raise ValueError(
-                f"{model_config.dtype} is not supported for quantization "
-                f"method {model_config.quantization}. Supported dtypes: "
-                f"{supported_dtypes}")
-        linear_method = quant_config.get_linear_method()
+        linear_method = _get_linear_method(quant_config,
+                                           model_config.quantization,
+                                           "quantization", model_config.dtype)
     if model_config.sparsity is not None:
         sparse_config = get_sparse_config(model_config.sparsity,
                                           model_config.model,
                                           model_config.hf_config,
                                           model_config.download_dir)
-        capability = torch.cuda.get_device_capability()
-        capability = capability[0] * 10 + capability[1]
-        if capability < sparse_config.get_min_capability():
-            raise ValueError(
-                f"The sparsity method {model_config.sparsity} is not "
-                "supported for the current GPU. "
-                f"Minimum capability: {sparse_config.get_min_capability()}. "
-                f"Current capability: {capability}.")
-        supported_dtypes = sparse_config.get_supported_act_dtypes()
-        if model_config.dtype not in supported_dtypes:
-            raise ValueError(
-                f"{model_config.dtype} is not supported for sparsity "
-                f"method {model_config.sparsity}. Supported dtypes: "
-                f"{supported_dtypes}")
-        linear_method = sparse_config.get_linear_method()
+        linear_method = _get_linear_method(sparse_config,
+                                           model_config.sparsity, "sparsity",
+                                           model_config.dtype)
+
+    # Download the weights in the background while the model is being built.
+    # This is a daemon thread so that it does not keep the process alive if
+    # building the model fails.
+    weights_prefetch = None
+    if model_config.load_format != "dummy":
+        weights_prefetch = threading.Thread(target=_prefetch_weights,
+                                            args=(model_config, ),
+                                            daemon=True)
+        weights_prefetch.start()
 
     with _set_default_torch_dtype(model_config.dtype):
         # Create a model instance.
         # The weights will be initialized as empty tensors.
         with torch.device("cuda"):
-            if getattr(model_class, "supports_lora", False):
+            if supports_lora:
                 model = model_class(model_config.hf_config, linear_method,
                                     lora_config)
-            elif lora_config:
-                raise ValueError(
-                    f"Model {model_class.__name__} does not support LoRA, "
-                    "but LoRA is enabled. Support for this model may "
-                    "be added in the future. If this is important to you, "
-                    "please open an issue on github.")
             else:
                 model = model_class(model_config.hf_config, linear_method)
         if model_config.load_format == "dummy":
@@ -101,6 +140,18 @@ def get_model(model_config: ModelConfig,
             initialize_dummy_weights(model)
         else:
             # Load the weights from the cached or downloaded files.
+            # Wait for the download, the page cache read-ahead continues in
+            # the background.
+            weights_prefetch.join()
             model.load_weights(model_config.model, model_config.download_dir,
                                model_config.load_format, model_config.revision)
+
+    # Let the linear methods specialize on the loaded weights.
+    for module in model.modules():
+        module_linear_method = getattr(module, "linear_method", None)
+        module_linear_weights = getattr(module, "linear_weights", None)
+        if (module_linear_method is not None
+                and module_linear_weights is not None):
+            module_linear_method.process_weights_after_loading(
+                module_linear_weights)
     return model.eval()
@@ -4,15 +4,19 @@ import glob
 import fnmatch
 import json
 import os
+import threading
 from collections import defaultdict
-from typing import Any, Iterator, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, List, Optional, Tuple, TypeVar
 
 from huggingface_hub import snapshot_download, HfFileSystem
 import numpy as np
+import psutil
 from safetensors.torch import load_file, save_file, safe_open
 import torch
 from transformers import PretrainedConfig
 from tqdm.auto import tqdm
+from magic_wand import SparseSemiStructuredStorageFormat
 
 from vllm.logger import init_logger
 from vllm.model_executor.layers.quantization import (get_quantization_config,
@@ -23,6 +27,11 @@ from vllm.model_executor.layers.parameters import LazyCompressedParameter
 
 logger = init_logger(__name__)
 
+T = TypeVar("T")
+
+# Returned by next() on an exhausted iterator in `_prefetch_iterator`
+_END_OF_ITERATION = object()
+
 
 class Disabledtqdm(tqdm):
 
@@ -219,12 +228,95 @@ def prepare_hf_model_weights(
     return hf_folder, hf_weights_files, use_safetensors
 
 
+def _advise_will_need(hf_weights_files: List[str]) -> None:
+    for weights_file in hf_weights_files:
+        fd = os.open(weights_file, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def prefetch_hf_model_weights(
+    model_name_or_path: str,
+    cache_dir: Optional[str] = None,
+    load_format: str = "auto",
+    revision: Optional[str] = None,
+) -> None:
+    """Download the model weights if needed, then let the OS start reading
+    them into the page cache in the background, so that a later
+    `hf_model_weights_iterator` call blocks less on IO.
+
+    Returns once the weights are downloaded, without waiting for the
+    read-ahead.
+    """
+    _, hf_weights_files, _ = prepare_hf_model_weights(model_name_or_path,
+                                                      cache_dir,
+                                                      load_format,
+                                                      revision=revision)
+    # npcache reads the weights from its own numpy files instead.
+    if load_format == "npcache" or not hasattr(os, "posix_fadvise"):
+        return
+    # Reading ahead more than fits in memory would evict the first files
+    # before they are loaded.
+    total_size = sum(os.path.getsize(f) for f in hf_weights_files)
+    if total_size > psutil.virtual_memory().available:
+        return
+    threading.Thread(target=_advise_will_need,
+                     args=(hf_weights_files, ),
+                     daemon=True).start()
+
+
+def _prefetch_iterator(iterator: Iterator[T]) -> Iterator[T]:
+    """Produce the next item of `iterator` on a worker thread while the
+    caller consumes the current one."""
+    # The current CUDA device is per thread. Any CUDA call the iterator makes
+    # (e.g. torch.cuda.empty_cache()) must not run on the default device, as
+    # that would create a CUDA context on GPU 0 in every worker.
+    initializer, initargs = None, ()
+    if torch.cuda.is_initialized():
+        initializer = torch.cuda.set_device
+        initargs = (torch.cuda.current_device(), )
+    try:
+        with ThreadPoolExecutor(max_workers=1,
+                                initializer=initializer,
+                                initargs=initargs) as executor:
+            next_item = executor.submit(next, iterator, _END_OF_ITERATION)
+            while True:
+                item = next_item.result()
+                if item is _END_OF_ITERATION:
+                    return
+                next_item = executor.submit(next, iterator, _END_OF_ITERATION)
+                yield item
+    finally:
+        # The executor has waited for any in-flight next() here, so it is
+        # safe to close the iterator and release what it holds (e.g. open
+        # files) if we were closed early.
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+
+
 def hf_model_weights_iterator(
     model_name_or_path: str,
     cache_dir: Optional[str] = None,
     load_format: str = "auto",
     revision: Optional[str] = None,
     fall_back_to_pt: Optional[bool] = True,
+) -> Iterator[Tuple[str, torch.Tensor]]:
+    # Read the next weight from disk while the caller copies the current
+    # one to the GPU.
+    yield from _prefetch_iterator(
+        _hf_model_weights_iterator(model_name_or_path, cache_dir, load_format,
+                                   revision, fall_back_to_pt))
+
+
+def _hf_model_weights_iterator(
+    model_name_or_path: str,
+    cache_dir: Optional[str] = None,
+    load_format: str = "auto",
+    revision: Optional[str] = None,
+    fall_back_to_pt: Optional[bool] = True,
 ) -> Iterator[Tuple[str, torch.Tensor]]:
     hf_folder, hf_weights_files, use_safetensors = prepare_hf_model_weights(
         model_name_or_path,
@@ -315,7 +407,22 @@ def initialize_dummy_weights(
     measurements. Additionally, the model weights should not cause NaNs in the
     forward pass. We empirically found that initializing the weights with
     values between -1e-3 and 1e-3 works well for most models.
+
+    Sparse weights are made 50% sparse, with a 2:4 pattern for the
+    semi-structured format and unstructured otherwise, and compressed, so
+    that the sparse kernels are exercised as they would be with real weights.
     """
-    for param in model.state_dict().values():
-        if torch.is_floating_point(param):
+    for param in model.state_dict(keep_vars=True).values():
+        if isinstance(param, LazyCompressedParameter):
+            data = param.uncompressed_data
+            data.uniform_(low, high)
+            if (param.storage_format_cls is SparseSemiStructuredStorageFormat
+                    and data.shape[-1] % 4 == 0):
+                # Zero the first 2 elements of every group of 4 along the
+                # last dim
+                data.view(-1, 4)[:, :2].zero_()
+            else:
+                data.masked_fill_(torch.rand_like(data) < 0.5, 0)
+            param.compress()
+        elif torch.is_floating_point(param):
             param.data.uniform_(low, high)